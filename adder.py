@@ -20,29 +20,20 @@ cin = SatVar('cin')
 s = SatVar('s')
 cout = SatVar('cout')
 
-# Internal variables (if needed)
-s0 = SatVar('s0')
-s1 = SatVar('s1')
-s2 = SatVar('s2')
-
-def gate_and(in1: SatVar, in2: SatVar, out: SatVar) -> Cnf :
-    return (~in1|~in2|out) & (in1|~out) & (in2|~out)
-
-def gate_or(in1: SatVar, in2: SatVar, out: SatVar) -> Cnf :
-    return (in1|in2|~out) & (~in1|out) & (~in2|out)
-
-def gate_xor(in1: SatVar, in2: SatVar, out: SatVar) -> Cnf :
-    return (~in1|~in2|~out) & (in1|in2|~out) & (in1|~in2|out) & (~in1|in2|out)
-
+# Direct CNF of the full adder, without internal variables. The sum s is the
+# parity a ^ b ^ cin: its 8 clauses each exclude one assignment of (a, b, cin, s)
+# with an odd number of ones. The carry cout is the majority of a, b and cin:
+# any two inputs at 1 force cout to 1, any two inputs at 0 force it to 0. This
+# gives 14 clauses, instead of the 17 clauses and 3 internal variables of the
+# gate by gate Tseitin encoding of the circuit above.
+FULL_ADDER_CLAUSES = [
+    # s = a ^ b ^ cin
+    (a|b|cin|~s), (a|b|~cin|s), (a|~b|cin|s), (~a|b|cin|s),
+    (a|~b|~cin|~s), (~a|b|~cin|~s), (~a|~b|cin|~s), (~a|~b|~cin|s),
+    # cout = (a & b) | (a & cin) | (b & cin)
+    (~a|~b|cout), (~a|~cin|cout), (~b|~cin|cout),
+    (a|b|~cout), (a|cin|~cout), (b|cin|~cout),
+]
 
 def mk_adder() -> Cnf:
-    add1 = gate_xor(a, b ,s0)
-    add2 = gate_xor(s0, cin, s)
-    add_cnf =  add1 & add2
-
-    carry1 = gate_and(a, b, s1)
-    carry2 = gate_and(s0, cin, s2)
-    carry3 = gate_or(s1, s2, cout)
-    carry_cnf = carry1 & carry2 & carry3
-
-    return add_cnf & carry_cnf
+    return Cnf(FULL_ADDER_CLAUSES)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+
+import circuit.circuit as circ
+import ec
+
+# This script times the equivalence checker, sequentially and with a number
+# of worker processes (given as arguments, 2 and 4 by default).
+#
+# The parallel check pays for starting the workers and for transforming the
+# logic shared by several batches of outputs more than once. It does not pay
+# off on the adders, which the sequential check already proves in a fraction
+# of a second. It helps on the multipliers (mul7 and mul7b multiply the same
+# operands in a different order), whose miters are hard to solve: each batch
+# of outputs gives a smaller problem, and the batches are solved at once on
+# several cores.
+
+benchmarks = [
+    ('cra32', 'cla32'),
+    ('faulty32', 'cla32'),
+    ('mul7', 'mul7b'),
+]
+
+if __name__ == '__main__':
+    workers = [int(w) for w in sys.argv[1:]] or [2, 4]
+
+    print ("{:<20}{:>12}".format('circuits', 'sequential')
+           + ''.join("{:>12}".format('%d workers' % w) for w in workers))
+    for name1, name2 in benchmarks:
+        c1 = circ.parse('benchmarks/%s.crc' % name1)
+        c2 = circ.parse('benchmarks/%s.crc' % name2)
+        times = []
+        for w in [None] + workers:
+            start = time.time()
+            ec.check(c1, c2, w)
+            times.append(time.time() - start)
+        print ("{:<20}".format(name1 + ' ' + name2)
+               + ''.join("{:>11.2f}s".format(t) for t in times))
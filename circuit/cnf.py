@@ -3,6 +3,7 @@
 import satispy
 from satispy.solver import Minisat
 from functools import reduce
+from itertools import product
 
 def maxvar(clauses):
     m = 0
@@ -16,31 +17,48 @@ class Cnf(object):
     product of sum form (POS).
     '''
     
-    def __init__(self, clauses = []):
-        '''Constructor. If defined, the CNF is initialized with the given set of clauses.'''
+    def __init__(self, clauses = [], xors = []):
+        '''Constructor. If defined, the CNF is initialized with the given set of clauses.
+        Any iterable of clauses can be given, including a generator. The optional
+        xors are XOR constraints (Xor) that are part of the formula as well.'''
 
         self.clauses = [cl for cl in clauses]
+        self.xors = [x for x in xors]
         self.variables = set()
-        for c in clauses:
+        for c in self.clauses + self.xors:
             self.variables |= {l.name for l in c.literals}
-        self.maxVar = maxvar(clauses)
+        self.maxVar = maxvar(self.clauses + self.xors)
 
     def className(self):
         return 'Cnf'
 
+    @staticmethod
+    def conjunction(*cnfs):
+        '''Returns the conjunction of the given CNFs (or clauses, or
+        literals). The result is built at once, instead of copying the
+        clauses for every & of a chain.'''
+
+        cnf = Cnf()
+        for other in cnfs:
+            cnf &= other
+        return cnf
+
     def __and__(self, other):
         if type(other) is Cnf:
-            return Cnf([l for l in self.clauses + other.clauses])
+            return Cnf([l for l in self.clauses + other.clauses], self.xors + other.xors)
         elif other.className() == 'Clause':
-            return Cnf([l for l in self.clauses + [other]])
+            return Cnf([l for l in self.clauses + [other]], self.xors)
+        elif other.className() == 'Xor':
+            return Cnf(self.clauses, self.xors + [other])
         elif other.className() == 'SatVar':
-            return Cnf(self.clauses + [Clause([other])])
+            return Cnf(self.clauses + [Clause([other])], self.xors)
         else:
             raise TypeError('incompatible types')
 
     def __iand__(self, other):
         if type(other) is Cnf:
             self.clauses += [l for l in other.clauses]
+            self.xors += [x for x in other.xors]
             self.variables |= other.variables
             self.maxVar = max(self.maxVar, other.maxVar)
             return self
@@ -49,6 +67,11 @@ class Cnf(object):
             self.variables |= {l.name for l in other.literals}
             self.maxVar = max(self.maxVar, maxvar([other]))
             return self
+        elif other.className() == 'Xor':
+            self.xors.append(other)
+            self.variables |= {l.name for l in other.literals}
+            self.maxVar = max(self.maxVar, maxvar([other]))
+            return self
         elif other.className() == 'SatVar':
             self.clauses.append(Clause([other]))
             self.variables.add(other.name)
@@ -59,15 +82,16 @@ class Cnf(object):
         return self
 
     def dimacs(self):
-        '''Dump CNF in DIMACS format'''
+        '''Dump CNF in DIMACS format. XOR constraints are dumped as 'x'
+        lines, as understood by CryptoMiniSat.'''
 
-        s = 'p cnf %d %d\n' % (self.maxVar, len(self.clauses))
-        cls = [c.dimacs() for c in self.clauses]
+        s = 'p cnf %d %d\n' % (self.maxVar, len(self.clauses) + len(self.xors))
+        cls = [c.dimacs() for c in self.clauses + self.xors]
         s += '\n'.join(cls)
         return s        
             
     def __repr__(self):
-        cls = [str(c) for c in self.clauses]
+        cls = [str(c) for c in self.clauses + self.xors]
         s = ' & '.join(cls)
         return s        
         
@@ -126,6 +150,44 @@ class Clause(object):
         return ' '.join(lits) + ' 0'
     
 
+class Xor(object):
+    '''Represents a XOR constraint: the XOR of the literals must be equal
+    to rhs. Solvers such as CryptoMiniSat handle these constraints
+    natively, for the others they are expanded into clauses.'''
+
+    def __init__(self, literals = [], rhs = True):
+        self.literals = [l for l in literals]
+        self.rhs = rhs
+
+    def className(self):
+        return 'Xor'
+
+    def clauses(self):
+        '''Expand the constraint into clauses. Each clause excludes one
+        assignment of the literals whose XOR differs from rhs, that is
+        the clauses with an even number of negated literals if rhs is
+        true, and with an odd number otherwise.'''
+
+        cls = []
+        for phases in product([True, False], repeat=len(self.literals)):
+            if (phases.count(False) % 2 == 0) == self.rhs:
+                cls.append(Clause([l if p else ~l for l, p in zip(self.literals, phases)]))
+        return cls
+
+    def __repr__(self):
+        lits = [str(l) for l in self.literals]
+        s = '(' + ' ^ '.join(lits) + ')'
+        return s if self.rhs else '~' + s
+
+    def dimacs(self):
+        '''Dump the constraint in the DIMACS format of CryptoMiniSat'''
+
+        lits = [l.dimacs() for l in self.literals]
+        if not self.rhs and lits:
+            lits[0] = (~self.literals[0]).dimacs()
+        return 'x' + ' '.join(lits) + ' 0'
+
+
 class SatVar(object):
     '''Represents a variable used to construct a CNF. The declared
     variables are given a unique integer identifier, starting with
@@ -193,7 +255,14 @@ class SatVar(object):
         return x < y
 
     def __invert__(self):
-        return SatVar(self.name, not self.phase)
+        # The negation keeps the id instead of looking the name up again:
+        # a literal unpickled in another process (e.g. a spawned worker)
+        # must not get a fresh id from that process' table.
+        lit = SatVar.__new__(SatVar)
+        lit.name = self.name
+        lit.phase = not self.phase
+        lit.id = self.id
+        return lit
 
     def __or__(self, other):
         if type(other) is SatVar:
@@ -267,37 +336,55 @@ class Solution:
     
 class Solver:
     '''SAT solver interface. Call solve() on a CNF object to solve it.'''
+
+    # Whether the backend handles XOR constraints natively. Minisat does
+    # not, so they are expanded into clauses.
+    native_xor = False
     
     def __init__(self):
         self.solver = Minisat()
+        self.cnf = None
+        self.dis = set()
+        self.ids = dict()
+        self.translated = 0
 
-    def solve(self, cnf):
+    def solve(self, cnf, assumptions = []):
         '''Solve a SAT problem in CNF form. Internally calls Minisat. Returns
-        a Solution object.'''
+        a Solution object.
+
+        The optional assumptions are literals (SatVar) that are assumed to
+        be true for this call only; they are not added to the CNF. When
+        solve() is called again on the same CNF object, only the clauses
+        added since the previous call are translated for the solver.
+
+        The clauses are handed to Minisat in DIMACS form: the variables are
+        identified by their integer ids, and the clause sets are built
+        directly instead of combining satispy expressions clause by clause.'''
         
         if type(cnf) is Clause:            
-            return self.solve(Cnf({cnf}))
+            return self.solve(Cnf({cnf}), assumptions)
         elif type(cnf) is SatVar:
-            return self.solve(Clause({cnf}))                              
+            return self.solve(Clause({cnf}), assumptions)
         def literal(lit):
-            v = satispy.Variable(lit.name)
-            if lit:
-                return v
-            else:
-                return -v
+            return satispy.Variable(lit.id, not lit.phase)
         def clause(cls):
-            lits = [literal(l) for l in cls.literals]
-            c = lits.pop()
-            for l in lits:
-                c = c | l
-            return c
-        clauses = [clause(c) for c in cnf.clauses]
-        expr = clauses.pop()
-        for c in clauses:
-            expr = expr & c
+            for l in cls.literals:
+                self.ids[l.name] = l.id
+            return frozenset([literal(l) for l in cls.literals])
+        if cnf is not self.cnf or len(cnf.clauses) < self.translated:
+            self.cnf = cnf
+            self.dis = set()
+            self.ids = dict()
+            self.translated = 0
+        self.dis.update([clause(c) for c in cnf.clauses[self.translated:]])
+        self.translated = len(cnf.clauses)
+        xors = [clause(c) for x in cnf.xors for c in x.clauses()]
+        expr = satispy.Cnf()
+        expr.dis = frozenset(self.dis).union(xors, [frozenset([literal(l)]) for l in assumptions])
         solution = self.solver.solve(expr)
         if solution.success:
-            assignment = {x: solution[satispy.Variable(x)] for x in cnf.variables}
+            assignment = {x: solution.varmap.get(satispy.Variable(self.ids[x]), False)
+                          for x in cnf.variables}
             return Solution(True, assignment)
         else:
             return Solution(False)
@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import queue
+import shutil
+import signal
+import tempfile
+import multiprocessing
 
 import circuit.circuit as circ
-from circuit.cnf import SatVar, Solver, Solution, Cnf
+from circuit.cnf import SatVar, Solver, Solution, Cnf, Clause, Xor
 from circuit.circuit import Circuit
+from circuit.circuit import Variable, Literal
 from transform import transform
-from transform import gate_xor
-from transform import gate_or
-from transform import equivalent
+from transform import xor_clauses
+from transform import POS, BOTH
 
 # Implementation hints:
 #
@@ -25,54 +31,327 @@ from transform import equivalent
 #
 # 3) Run the test script to see if your code works!
 
-def createInputCnf(inputs: set, prefix1: str, prefix2: str) -> Cnf:
-    '''The fucntion createInputCnf takes the common inputs of the circuits being checked,
-    taking into account their different prefixes, and builds the input connections required
-    by the miter circuit logic. Its output is the cnf representing these connections
-    '''
-    inputCnf = Cnf()
-
-    for i in inputs:
-        inputCnf &= equivalent(SatVar(i), SatVar(prefix1 + i))
-        inputCnf &= equivalent(SatVar(i), SatVar(prefix2 + i))
-
-    return inputCnf
-
-def createComparatorCnf(outputs: set, prefix1: str, prefix2: str) -> (Cnf, SatVar):
-    '''The function createComparatorCnf takes the common outputs of the circuits being checked,
-    taking into account their differente prefixes, and builds the output miter logic
-    with its XOR and OR gates. Its output is both the miter output CNF and the SatVar
-    variable for the miter output symbol
+def comparatorClauses(outputs: set, prefix1: str, prefix2: str, native_xor: bool=False):
+    '''The function comparatorClauses takes the common outputs of the circuits being checked,
+    taking into account their differente prefixes, and yields the clauses of the output miter
+    logic: XOR gates comparing the outputs and a single clause requiring at least one of them
+    to be true, which already asserts the miter output. As the XOR gates are only required to
+    be true, they are encoded for the positive polarity only (Plaisted-Greenbaum). If
+    native_xor is set, each XOR gate is yielded as a single XOR constraint instead.
     '''
     # Generation of XOR gates for miter circuit output
-    comparator = Cnf()
     comp_signals = []
     i = 0
     for output in outputs:
         xor_i = SatVar('xor_' + str(i))
         output1 = SatVar(prefix1 + output)
         output2 = SatVar(prefix2 + output)
-        comparator &= gate_xor(output1, output2, xor_i)
+        if native_xor:
+            yield Xor([output1, output2, xor_i], False)
+        else:
+            yield from xor_clauses(output1, output2, xor_i, POS)
         comp_signals.append(xor_i)
         i += 1
 
-    # Generation of OR gates for miter circuit output
-    or_neutral = SatVar('or_neutral')
-    comparator &= (~or_neutral)
-    i = 0
-    for xor_i in comp_signals:
-        out = SatVar('or_' + str(i))
-        curr = xor_i
-        if i == 0:
-            comparator &= gate_or(or_neutral, xor_i, out)
+    # Miter output: a single n-ary OR clause over the XOR gates
+    yield Clause(comp_signals)
+
+def createComparatorCnf(outputs: set, prefix1: str, prefix2: str, native_xor: bool=False) -> Cnf:
+    '''The function createComparatorCnf returns the output miter logic built by
+    comparatorClauses as a CNF.
+    '''
+    return Cnf.conjunction(*comparatorClauses(outputs, prefix1, prefix2, native_xor))
+
+def simplifyCnf(cnf: Cnf) -> (Cnf, dict):
+    '''The function simplifyCnf takes a CNF and reduces it before it is handed to the
+    solver. Pairs of binary clauses (x | y) & (~x | ~y) show that x is equivalent to ~y:
+    such variables are merged with a union-find structure and replaced by a single
+    representative. Unit clauses are then propagated, removing satisfied clauses and
+    false literals. Both steps are repeated until nothing changes, after which the XOR
+    constraints are rewritten over the remaining variables. Its output is the
+    simplified CNF (None if it turned out to be unsatisfiable) and a dictionary mapping
+    the names of the eliminated variables to either their Boolean value or the literal
+    of the simplified CNF they are equal to.
+    '''
+    # Clauses as lists of DIMACS literals (variable id, negative if inverted)
+    names = dict()
+    clauses = []
+    for cl in cnf.clauses:
+        lits = []
+        for l in cl.literals:
+            names[l.id] = l.name
+            lits.append(l.id if l.phase else -l.id)
+        clauses.append(lits)
+    for x in cnf.xors:
+        for l in x.literals:
+            names[l.id] = l.name
+
+    # Union-find over literals: parent[v] is a literal equivalent to variable v
+    parent = dict()
+    fixed = dict()
+
+    def find(lit):
+        path = []
+        while abs(lit) in parent:
+            path.append(lit)
+            lit = parent[abs(lit)] if lit > 0 else -parent[abs(lit)]
+        for l in path:
+            parent[abs(l)] = lit if l > 0 else -lit
+        return lit
+
+    changed = True
+    while changed:
+        changed = False
+
+        # Equivalent variables
+        binary = {frozenset(cl) for cl in clauses if len(set(cl)) == 2}
+        for cl in binary:
+            x, y = cl
+            if frozenset((-x, -y)) in binary:
+                rx, ry = find(x), find(-y)
+                if rx == -ry:
+                    return None, None
+                if rx != ry:
+                    parent[abs(rx)] = ry if rx > 0 else -ry
+                    changed = True
+
+        # Substitution of the representatives and unit propagation
+        propagate = True
+        while propagate:
+            propagate = False
+            simplified = []
+            for cl in clauses:
+                lits = set()
+                satisfied = False
+                for l in cl:
+                    l = find(l)
+                    value = fixed.get(abs(l))
+                    if value is None:
+                        lits.add(l)
+                    elif value == (l > 0):
+                        satisfied = True
+                        break
+                if satisfied or any(-l in lits for l in lits):
+                    continue
+                if len(lits) == 0:
+                    return None, None
+                if len(lits) == 1:
+                    l = lits.pop()
+                    fixed[abs(l)] = l > 0
+                    propagate = changed = True
+                else:
+                    simplified.append(list(lits))
+            clauses = simplified
+
+    # Eliminated variables, either fixed or replaced by their representative
+    eliminated = dict()
+    for v, name in names.items():
+        l = find(v)
+        if abs(l) in fixed:
+            eliminated[name] = fixed[abs(l)] == (l > 0)
+        elif l != v:
+            eliminated[name] = SatVar(names[abs(l)], l > 0)
+
+    # Repeated clauses are only kept once
+    clauses = {frozenset(cl) for cl in clauses}
+
+    # XOR constraints over the representatives, without the fixed variables
+    xors = []
+    for x in cnf.xors:
+        variables = set()
+        rhs = x.rhs
+        for l in x.literals:
+            l = find(l.id if l.phase else -l.id)
+            if l < 0:
+                rhs = not rhs
+            if abs(l) in fixed:
+                rhs = rhs != fixed[abs(l)]
+            else:
+                variables ^= {abs(l)}
+        if variables:
+            xors.append((variables, rhs))
+        elif rhs:
+            return None, None
+
+    def literal(l):
+        return SatVar(names[abs(l)], l > 0)
+    return (Cnf([Clause([literal(l) for l in cl]) for cl in clauses],
+                [Xor([literal(v) for v in vs], rhs) for vs, rhs in xors]),
+            eliminated)
+
+def expandSolution(solution: Solution, eliminated: dict, inputs: set=set()) -> Solution:
+    '''The function expandSolution takes a solution of a CNF simplified by simplifyCnf,
+    together with the eliminated variables, and returns the corresponding solution of the
+    original CNF. The given inputs that do not occur in the CNF, as they are outside the
+    compared cones, are set to False so that the counterexample covers all of them.
+    '''
+    assignment = dict(solution.assignment)
+    for name, value in eliminated.items():
+        if type(value) is bool:
+            assignment[name] = value
         else:
-            prev = SatVar('or_' + str(i-1))
-            comparator &= gate_or(prev, xor_i, out)
-        i += 1
+            assignment[name] = assignment.get(value.name, False) == value.phase
+    for name in inputs:
+        assignment.setdefault(name, False)
+    return Solution(True, assignment)
+
+def structuralHashes(c: Circuit, table: dict) -> dict:
+    '''The function structuralHashes takes a Circuit and a table shared by the circuits
+    being compared, and returns a dictionary mapping each output to an integer identifying
+    the structure of its cone. The nodes are hashed bottom-up from their operation and the
+    hashes of their children (hash-consing): the table gives the same integer to the same
+    structure, so two outputs get the same integer exactly when their cones are identical
+    up to the names of internal signals and the order of commutative operands.
+    '''
+    signals = c.getSignals()
+    hashes = dict()
 
-    return comparator, out
+    def children(n):
+        # A reference to an internal signal stands for the signal's equation
+        if isinstance(n, Variable) and n.getName() in signals:
+            return [c.getEquation(n.getName())]
+        return n.getChildren()
+
+    # Iterative post-order traversal of the output cones
+    stack = [(c.getEquation(output), False) for output in c.getOutputs()]
+    while stack:
+        n, visited = stack.pop()
+        if n.getID() in hashes:
+            continue
+        if not visited:
+            stack.append((n, True))
+            stack += [(child, False) for child in children(n) if child.getID() not in hashes]
+            continue
+
+        if isinstance(n, Literal):
+            key = ('lit', n.getValue())
+        elif isinstance(n, Variable) and n.getName() in signals:
+            hashes[n.getID()] = hashes[c.getEquation(n.getName()).getID()]
+            continue
+        elif isinstance(n, Variable):
+            key = ('input', n.getName())
+        else:
+            kids = [hashes[child.getID()] for child in n.getChildren()]
+            if n.getOp() in '&|^':
+                kids.sort()
+            key = (n.getOp(),) + tuple(kids)
+        hashes[n.getID()] = table.setdefault(key, len(table))
+
+    return {output: hashes[c.getEquation(output).getID()] for output in c.getOutputs()}
+
+def createMiter(c1: Circuit, c2: Circuit, outputs: set, prefix1: str, prefix2: str,
+                native_xor: bool=False) -> Cnf:
+    '''The function createMiter builds the miter CNF comparing the given outputs of the
+    two circuits. Only the cones of these outputs are transformed. The inputs are not
+    prefixed, so that both circuits share the same input variables and no clauses are
+    needed to connect them. If native_xor is set, the XOR gates of the circuits and of
+    the comparator are encoded by XOR constraints.
+    '''
+    # Tseitin Transformation of the two circuits, the outputs are compared by XOR
+    # gates and are thus required in both polarities
+    polarity = {output: BOTH for output in outputs}
+    cnf1 = transform(c1, prefix1, polarity, '', native_xor)
+    cnf2 = transform(c2, prefix2, polarity, '', native_xor)
+
+    # Generating comparison logic for miter circuit
+    comparator = createComparatorCnf(outputs, prefix1, prefix2, native_xor)
 
-def check(c1: Circuit, c2: Circuit) -> (bool, Solution):
+    # Composition of the miter circuit
+    return Cnf.conjunction(cnf1, cnf2, comparator)
+
+def checkOutputs(c1: Circuit, c2: Circuit, outputs: set, prefix1: str, prefix2: str,
+                 native_xor: bool=False) -> (bool, Solution):
+    '''The function checkOutputs compares the given outputs of the two circuits with a
+    single miter, which is simplified and then solved. It returns the same tuple as check.
+    '''
+    miter = createMiter(c1, c2, outputs, prefix1, prefix2, native_xor)
+
+    # Simplification of the miter before solving
+    miter, eliminated = simplifyCnf(miter)
+    if miter is None:
+        return True, None
+
+    # Nothing left to solve: the simplification already satisfied the miter
+    if not miter.clauses and not miter.xors:
+        return False, expandSolution(Solution(True, {}), eliminated, c1.getInputs())
+
+    # CNF SAT solving
+    solver = Solver()
+    solution = solver.solve(miter)
+
+    if solution:
+        return False, expandSolution(solution, eliminated, c1.getInputs())
+    return True, None
+
+def checkBatch(c1: Circuit, c2: Circuit, outputs: set, prefix1: str, prefix2: str,
+               native_xor: bool, results, directory: str):
+    '''The function checkBatch runs checkOutputs in a worker process and puts its result
+    (or the exception it raised) in the results queue. The worker leads its own process
+    group, so that the solver it runs is killed together with it, and the solver writes
+    its temporary files in the given directory, which is removed once the worker stops.
+    '''
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    tempfile.tempdir = directory
+    try:
+        results.put(checkOutputs(c1, c2, outputs, prefix1, prefix2, native_xor))
+    except Exception as e:
+        results.put(e)
+
+def stopWorker(p, directory: str):
+    '''The function stopWorker kills a worker process of checkParallel, with its solver,
+    and removes its temporary directory.'''
+    if p.is_alive():
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except (AttributeError, ProcessLookupError, PermissionError):
+            # No process group of its own (yet)
+            p.terminate()
+    p.join()
+    shutil.rmtree(directory, ignore_errors=True)
+
+def checkParallel(c1: Circuit, c2: Circuit, outputs: set, prefix1: str, prefix2: str,
+                  workers: int, native_xor: bool=False) -> (bool, Solution):
+    '''The function checkParallel splits the given outputs into (at most) workers batches
+    of neighbouring outputs, and compares each batch with its own miter in a worker
+    process: the transformation, the simplification and the solving of the miters all
+    run in parallel. As soon as a worker finds a counterexample, it is returned and the
+    other workers are killed, together with their running solvers.
+    '''
+    outputs = sorted(outputs)
+    size = -(-len(outputs) // workers)
+    results = multiprocessing.Queue()
+    batches = [set(outputs[i:i + size]) for i in range(0, len(outputs), size)]
+    directories = [tempfile.mkdtemp() for batch in batches]
+    processes = [multiprocessing.Process(target=checkBatch,
+                                         args=(c1, c2, batch, prefix1, prefix2,
+                                               native_xor, results, directory))
+                 for batch, directory in zip(batches, directories)]
+    for p in processes:
+        p.start()
+    try:
+        remaining = len(processes)
+        while remaining:
+            # If no worker was alive before waiting, all results were already sent
+            alive = any(p.is_alive() for p in processes)
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not alive:
+                    raise RuntimeError('a worker of the equivalence check died')
+                continue
+            remaining -= 1
+            if isinstance(result, Exception):
+                raise result
+            r, cex = result
+            if not r:
+                return False, cex
+        return True, None
+    finally:
+        for p, directory in zip(processes, directories):
+            stopWorker(p, directory)
+
+def check(c1: Circuit, c2: Circuit, workers: int=None, native_xor: bool=None) -> (bool, Solution):
     '''The function check() takes two Circuits as input and performs an equivalence
     check using a SAT solver. it returns a tuple, where the first entry is a
     Boolean value (True for equivalent, False for different) and the second
@@ -80,7 +359,15 @@ def check(c1: Circuit, c2: Circuit) -> (bool, Solution):
     SAT problem, representing a counterexample. If the circuits are indeed
     equivalent, the second entry will be None.
 
+    If a number of workers is given, the outputs are split into that many
+    batches, each compared by its own miter in a separate process.
+
+    If native_xor is set, XOR gates are encoded by XOR constraints instead of
+    clauses. By default, they are used if the Solver handles them natively.
+
     '''
+    if native_xor is None:
+        native_xor = Solver.native_xor
 
     inputs1 = c1.getInputs()
     inputs2 = c2.getInputs()
@@ -96,26 +383,18 @@ def check(c1: Circuit, c2: Circuit) -> (bool, Solution):
         if (len(inputs1 - inputs2) != 0) or (len(outputs1 - outputs2) != 0):
             return False, None
 
-    # Tseitin Transformation of the two circuits
-    cnf1 = transform(c1, prefix1)
-    cnf2 = transform(c2, prefix2)
+    # Structurally identical outputs are equivalent, only the others need to be compared
+    table = dict()
+    hashes1 = structuralHashes(c1, table)
+    hashes2 = structuralHashes(c2, table)
+    outputs = {output for output in outputs1 if hashes1[output] != hashes2[output]}
+    if not outputs:
+        return True, None
 
-    # Generating connection among correspondent inputs
-    inputConnections = createInputCnf(inputs1, prefix1, prefix2)
+    # Batches of outputs compared in parallel
+    if workers is not None and workers > 1 and len(outputs) > 1:
+        return checkParallel(c1, c2, outputs, prefix1, prefix2, workers, native_xor)
 
-    # Generating comparison logic for miter circuit
-    comparator, out = createComparatorCnf(outputs1, prefix1, prefix2)
-
-    # Composition of the miter circuit
-    miter = inputConnections & cnf1 & cnf2 & comparator & out
-
-    # CNF SAT solving
-    solver = Solver()
-    solution = solver.solve(miter)
-
-    if solution:
-        return False, solution
-    return True, None
+    return checkOutputs(c1, c2, outputs, prefix1, prefix2, native_xor)
 
     pass
-
@@ -2,6 +2,8 @@
 
 import os
 import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import circuit.circuit as circ
 from circuit.cnf import SatVar, Solver
@@ -102,6 +104,48 @@ def test_adder():
         pass_test = row(sim, sat) and pass_test
     return pass_test
 
+# =============================================================================
+# Test code for the solver interface
+# =============================================================================
+
+def test_solver():
+    a = SatVar('a')
+    b = SatVar('b')
+    c = SatVar('c')
+    cnf = (a | b) & (~a | c)
+    solver = Solver()
+
+    # Each case: assumptions, expected result, expected values
+    def solve(assumptions, sat, values):
+        solution = solver.solve(cnf, assumptions)
+        good = bool(solution) == sat
+        if good and solution:
+            good = all(solution[x] == v for x, v in values.items())
+        r = ' '.join(str(l) for l in assumptions) or '(none)'
+        if good:
+            print_result("assuming %s: %s" % (r, solution))
+        else:
+            print_error("assuming %s: %s, expected %s" %
+                        (r, solution, 'SAT' if sat else 'UNSAT'))
+        return good
+
+    succ = True
+    succ &= solve([~a], True, {'a': False, 'b': True})
+    succ &= solve([a, ~c], False, {})
+    succ &= solve([a], True, {'a': True, 'c': True})
+
+    # The assumptions are not added to the CNF
+    succ &= solve([], True, {})
+    if len(cnf.clauses) != 2:
+        print_error("The assumptions were added to the CNF.")
+        succ = False
+
+    # The clauses added since the previous call are taken into account
+    cnf &= ~b
+    succ &= solve([~a], False, {})
+    succ &= solve([], True, {'a': True, 'b': False, 'c': True})
+    return succ
+
 # =============================================================================
 # Test code for transform()
 # =============================================================================
@@ -119,10 +163,10 @@ def allSAT(cnf, blockVars = None):
         cnf &= block
 
 # Test if solutions of CNF are consistent with circuit simulations
-def check(filename, max_tests):
+def check(filename, max_tests, native_xor = False):
     c = circ.parse(filename)
     try:
-        cnf = transform.transform(c)
+        cnf = transform.transform(c, native_xor = native_xor)
     except Exception as e:
         print_error("Transformation of circuit '%s' failed." % c.name)
         print (e)
@@ -172,14 +216,20 @@ def test_transform(max_tests = 10):
         print_info("Testing transformation of circuit '%s'" % bench)
         b,i,j = check(bench, max_tests)
         all_passed = b and (i == j) and all_passed
+
+    # XOR gates encoded as XOR constraints
+    for bench in ['./benchmarks/xor.crc', './benchmarks/fa.crc']:
+        print_info("Testing transformation of circuit '%s' with XOR constraints" % bench)
+        b,i,j = check(bench, max_tests, True)
+        all_passed = b and (i == j) and all_passed
     return all_passed
 
 # =============================================================================
 # Test code for equivalence checker
 # =============================================================================
 
-def check_ec(c1, c2, result):
-    r, cex  = ec.check(c1, c2)
+def check_ec(c1, c2, result, workers = None, native_xor = False):
+    r, cex  = ec.check(c1, c2, workers, native_xor)
     if r:
         print_result("Circuits are EQUIVALENT")
     else:
@@ -189,6 +239,40 @@ def check_ec(c1, c2, result):
             print_error('Circuits are equivalent, but reported different.')
         else:
             print_error('Circuits are different, but reported equivalent.')
+        return False
+
+    # The counterexample must assign all inputs, and the circuits must
+    # differ on these inputs
+    if not r and cex is not None:
+        inputs = c1.getInputs()
+        if not all(i in cex.keys() for i in inputs):
+            print_error('Counterexample does not assign all inputs.')
+            return False
+        invalues = {i: cex[i] for i in inputs}
+        sim1 = c1.simulate(invalues)
+        sim2 = c2.simulate(invalues)
+        if all(sim1[o] == sim2[o] for o in c1.getOutputs()):
+            print_error('Counterexample does not distinguish the circuits.')
+            return False
+    return True
+
+# Solve the miter with XOR constraints in a spawned process, whose table of
+# SatVar ids is empty, as it happens for the workers of the parallel check
+def check_spawn(c1, c2, result):
+    miter = ec.createMiter(c1, c2, c1.getOutputs(), 'c1_', 'c2_', True)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context = context) as pool:
+        solution = pool.submit(Solver().solve, miter).result()
+    r = not solution
+    if r:
+        print_result("Circuits are EQUIVALENT")
+    else:
+        print_result("Circuits are DIFFERENT")
+    if r ^ result:
+        if result:
+            print_error('Circuits are equivalent, but reported different in a spawned process.')
+        else:
+            print_error('Circuits are different, but reported equivalent in a spawned process.')
     return r == result
 
 def test_ec():
@@ -236,6 +320,32 @@ def test_ec():
     succ &= check_ec(flt32, cla32, False)
     succ &= check_ec(cra32, flt32, False)
 
+    # Miters solved by simplification alone, negated and constant outputs
+    buf = circ.parse('benchmarks/buf.crc')
+    inv = circ.parse('benchmarks/inv.crc')
+    const = circ.parse('benchmarks/const.crc')
+
+    succ &= check_ec(buf, inv, False)
+    succ &= check_ec(buf, const, False)
+    succ &= check_ec(inv, const, False)
+    succ &= check_ec(buf, buf, True)
+
+    # One miter per output, solved in parallel
+    succ &= check_ec(buf, inv, False, 2)
+    succ &= check_ec(inv, const, False, 2)
+    succ &= check_ec(twoa, twob, False, 2)
+    succ &= check_ec(adder1, adder2, True, 2)
+    succ &= check_ec(adder1, adder4, False, 2)
+    succ &= check_ec(cra16, cla16, True, 2)
+
+    # XOR gates and miter comparators encoded as XOR constraints
+    succ &= check_ec(adder1, adder2, True, native_xor = True)
+    succ &= check_ec(adder1, adder4, False, native_xor = True)
+    succ &= check_ec(cra16, flt16, False, native_xor = True)
+    succ &= check_spawn(adder1, adder2, True)
+    succ &= check_spawn(cra16, cla16, True)
+    succ &= check_spawn(cra16, flt16, False)
+
     return succ
 
 # =============================================================================
@@ -256,6 +366,19 @@ if __name__ == '__main__':
         print (e)
         print(traceback.format_exc())
 
+    print_info("===========================================")
+    print_info("Testing solver interface")
+    print_info("===========================================")
+    try:
+        if test_solver():
+            print_passed("The solver interface is correct.")
+        else:
+            print_error("Some test cases failed, go debug your code.")
+    except Exception as e:
+        print_error("Something went seriously wrong.")
+        print (e)
+        print(traceback.format_exc())
+
     print_info("===========================================")
     print_info("Testing Tseitin transformation")
     print_info("===========================================")
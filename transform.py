@@ -3,7 +3,7 @@
 import sys
 
 import circuit.circuit as circ
-from circuit.cnf import SatVar, Solver, Cnf
+from circuit.cnf import SatVar, Solver, Cnf, Clause, Xor
 from circuit.circuit import Circuit
 from circuit.circuit import Node
 from circuit.circuit import OpNode
@@ -34,100 +34,263 @@ from circuit.circuit import Literal
 #    code passes all the tests, there is a good chance that it is
 #    correct.
 
-inputs = dict()
-outputs = dict()
-signals = dict()
+# Polarities of the Plaisted-Greenbaum encoding. A node that is only
+# required to be true (POS) needs the clauses out -> f(in) of its gate,
+# a node only required to be false (NEG) needs f(in) -> out. BOTH gives
+# the complete Tseitin encoding.
+POS = 1
+NEG = 2
+BOTH = POS | NEG
 
-def equivalent(in1: SatVar, out: SatVar) -> Cnf:
-    return (~in1 | out) & (in1 | ~out)
+class TransformState(object):
+    '''Holds the state of a single transformation, so that transform() does not
+    depend on module globals and several transformations can coexist.
+    '''
+
+    def __init__(self, c: Circuit, prefix: str, polarities: dict, input_prefix: str,
+                 native_xor: bool=False):
+        self.prefix = prefix
+        # SatVars of the inputs and of the signals (outputs and internal signals)
+        self.inputs = {in_str: SatVar(input_prefix + in_str) for in_str in c.getInputs()}
+        self.signals = {sig_str: SatVar(prefix + sig_str) for sig_str in c.getSignals()}
+        self.polarities = polarities
+        # Whether XOR gates are emitted as XOR constraints instead of clauses
+        self.native_xor = native_xor
+
+def gate_templates(pos: tuple, neg: tuple) -> dict:
+    '''Returns the clause templates of a gate for each polarity, given the templates of
+    its positive and negative halves. In a template, each clause is a tuple of literal
+    indices: i stands for the i-th variable of the gate (starting at 1, the output being
+    the last one) and -i for its negation.
+    '''
+    return {0: (), POS: pos, NEG: neg, BOTH: pos + neg}
+
+EQUIVALENT_TEMPLATES = gate_templates(((1, -2),), ((-1, 2),))
+NOT_TEMPLATES = gate_templates(((-1, -2),), ((1, 2),))
+AND_TEMPLATES = gate_templates(((1, -3), (2, -3)), ((-1, -2, 3),))
+OR_TEMPLATES = gate_templates(((1, 2, -3),), ((-1, 3), (-2, 3)))
+XOR_TEMPLATES = gate_templates(((-1, -2, -3), (1, 2, -3)), ((1, -2, 3), (-1, 2, 3)))
+
+def instantiate(template: tuple, variables: tuple) -> list:
+    '''Returns the clauses of a template for the given gate variables. The literals
+    are laid out so that the template indices can be used directly: lits[i] is the
+    i-th variable and lits[-i] its negation.
+    '''
+    lits = (None,) + variables + tuple(~v for v in reversed(variables))
+    return [Clause([lits[i] for i in cl]) for cl in template]
+
+def equivalent_clauses(in1: SatVar, out: SatVar, polarity: int=BOTH) -> list:
+    return instantiate(EQUIVALENT_TEMPLATES[polarity], (in1, out))
 
-def gate_not(in1: SatVar, out: SatVar) -> Cnf:
-    return (~in1|~out) & (in1|out)
+def xor_clauses(in1: SatVar, in2: SatVar, out: SatVar, polarity: int=BOTH) -> list:
+    return instantiate(XOR_TEMPLATES[polarity], (in1, in2, out))
 
-def gate_and(in1: SatVar, in2: SatVar, out: SatVar) -> Cnf:
-    return (~in1|~in2|out) & (in1|~out) & (in2|~out)
+# Operators of the OpNodes, and the clause templates of their gates by operator code
+# (the position of the operator in OPS)
+OPS = ('~', '&', '|', '^')
+OP_TEMPLATES = (NOT_TEMPLATES, AND_TEMPLATES, OR_TEMPLATES, XOR_TEMPLATES)
 
-def gate_or(in1: SatVar, in2: SatVar, out: SatVar) -> Cnf:
-    return (in1|in2|~out) & (~in1|out) & (~in2|out)
+def compute_polarities(c: Circuit, required: dict) -> dict:
+    '''The function compute_polarities takes a Circuit c and a dictionary mapping signal
+    names to the polarity in which they are required, and returns a dictionary mapping
+    the ID of every node of the circuit to the polarity in which it occurs. Negations
+    invert the polarity and XOR gates require both polarities of their inputs. Nodes
+    that do not occur in the returned dictionary need not be transformed at all.
+    '''
+    nodes = dict()
+    sigs = dict()
+    work = [(s, p) for s, p in required.items() if p]
+
+    while work:
+        s, p = work.pop()
+        if sigs.get(s, 0) | p == sigs.get(s, 0):
+            continue
+        sigs[s] = sigs.get(s, 0) | p
+
+        stack = [(c.getEquation(s), p)]
+        while stack:
+            n, p = stack.pop()
+            old = nodes.get(n.getID(), 0)
+            if old | p == old:
+                continue
+            nodes[n.getID()] = old | p
+            if isinstance(n, Variable):
+                if n.getName() in c.getSignals():
+                    work.append((n.getName(), p))
+            elif isinstance(n, OpNode):
+                if n.getOp() == '~':
+                    p = ((p & POS) and NEG) | ((p & NEG) and POS)
+                elif n.getOp() == '^':
+                    p = BOTH
+                for child in n.getChildren():
+                    stack.append((child, p))
+
+    return nodes
 
-def gate_xor(in1: SatVar, in2: SatVar, out: SatVar) -> Cnf:
-    return (~in1|~in2|~out) & (in1|in2|~out) & (in1|~in2|out) & (~in1|in2|out)
+# Kinds of the nodes of a FlatCircuit
+LITERAL = 0
+VARIABLE = 1
+OPERATION = 2
 
-def transform_node(n: Node, out: SatVar, c: Circuit) -> Cnf:
-    '''The function transformNode recursively analyses the nodes objects it receives and 
-    builds the corresponding CNF. Each step's output is its node's CNF so that the final
-    execution has the complete CNF for a given node.
+class FlatCircuit(object):
+    '''Structure of arrays form of the nodes of a circuit that need to be transformed.
+    Each node gets a position, children before their parents, and its attributes are
+    stored in parallel lists indexed by that position, so that the Tseitin transformation
+    becomes a single scan over plain lists instead of a traversal of node objects.
     '''
-    cnf = Cnf()
-
-    # Child nodes analysis for operation nodes
-    children = []
-    for child in n.getChildren():
-        if isinstance(child, Literal):
-            lit = SatVar('l_' + str(child.getID()))
-            children.append(lit)
-            if child.getValue() == True:
-                cnf &= lit
+
+    def __init__(self, c: Circuit, polarities: dict):
+        self.ids = []         # node IDs
+        self.kinds = []       # LITERAL, VARIABLE or OPERATION
+        self.ops = []         # operator codes (index in OPS), -1 if not an operation
+        self.children = []    # tuples of the positions of the children
+        self.values = []      # values of the literals, names of the variables
+        self.polarities = []  # polarities of the nodes
+
+        # Iterative post-order traversal of the equations of the required signals
+        position = dict()
+        stack = [(c.getEquation(sig_str), False) for sig_str in c.getSignals()
+                 if c.getEquation(sig_str).getID() in polarities]
+        while stack:
+            n, visited = stack.pop()
+            if n.getID() in position:
+                continue
+            if not visited:
+                stack.append((n, True))
+                stack += [(child, False) for child in n.getChildren()
+                          if child.getID() not in position]
+                continue
+
+            position[n.getID()] = len(self.ids)
+            self.ids.append(n.getID())
+            self.children.append(tuple(position[child.getID()] for child in n.getChildren()))
+            self.polarities.append(polarities[n.getID()])
+            if isinstance(n, OpNode):
+                self.kinds.append(OPERATION)
+                self.ops.append(OPS.index(n.getOp()))
+                self.values.append(None)
+            elif isinstance(n, Variable):
+                self.kinds.append(VARIABLE)
+                self.ops.append(-1)
+                self.values.append(n.getName())
             else:
-                cnf &= ~lit
-        elif isinstance(child, Variable):
-            if child.getName() in inputs:
-                var = inputs[child.getName()]
-            elif child.getName() in signals:
-                var = signals[child.getName()]
-            children.append(var)
-        elif isinstance(child, OpNode):
-            internal = SatVar('y_' + str(child.getID()))
-            children.append(internal)
-            cnf &= transform_node(child, internal, c)
-
-    # CNF building
-    if isinstance(n, OpNode):
-        if len(children) == 1:
-            if n.getOp() == '~':
-                cnf &= gate_not(children[0], out)
-        elif len(children) == 2:
-            if n.getOp() == '&':
-                cnf &= gate_and(children[0], children[1], out)
-            elif n.getOp() == '|':
-                cnf &= gate_or(children[0], children[1], out)
-            elif n.getOp() == '^':
-                cnf &= gate_xor(children[0], children[1], out)
-    elif isinstance(n, Variable):
-            cnf &= equivalent(signals[n.getName()], out)
-    elif isinstance(n, Literal):
-            lit = SatVar('l_' + str(n.getID()))
-            cnf &= equivalent(lit, out)
-            if n.getValue() == True:
-                cnf &= lit
+                self.kinds.append(LITERAL)
+                self.ops.append(-1)
+                self.values.append(n.getValue())
+
+        # Positions of the root nodes of the signals' equations
+        self.roots = {sig_str: position[c.getEquation(sig_str).getID()]
+                      for sig_str in c.getSignals()
+                      if c.getEquation(sig_str).getID() in position}
+
+def flat_variables(f: FlatCircuit, t: TransformState) -> list:
+    '''The function flat_variables returns the list of the variables of the nodes of the
+    flattened circuit f, by position. The variable of a node depends only on the node
+    itself, never on its children.
+    '''
+    prefix = t.prefix
+    inputs = t.inputs
+    signals = t.signals
+
+    # The root node of a signal's equation is represented by the signal's variable
+    outs = {p: signals[sig_str] for sig_str, p in f.roots.items()}
+
+    variables = [None] * len(f.ids)
+    for i, (kind, value, node_id) in enumerate(zip(f.kinds, f.values, f.ids)):
+        if kind == OPERATION:
+            out = outs.get(i)
+            variables[i] = out if out is not None else SatVar(prefix + 'y_' + str(node_id))
+        elif kind == VARIABLE:
+            variables[i] = inputs[value] if value in inputs else signals[value]
+        else:
+            variables[i] = SatVar(prefix + 'l_' + str(node_id))
+    return variables
+
+def flat_clauses(f: FlatCircuit, t: TransformState):
+    '''The function flat_clauses yields the clauses of the Tseitin transformation of the
+    flattened circuit f. Once the variables of all nodes are known, the clauses of each
+    node only depend on its own operator, polarity and children, so they are emitted by an
+    independent instantiation of the gate's template per node. Only the clauses required
+    by each node's polarity are emitted. If t.native_xor is set, each XOR gate is yielded
+    as a single XOR constraint (Xor) instead, which states in1 ^ in2 ^ out = 0: it encodes
+    both polarities at once, whatever the polarity of the node.
+    '''
+    variables = flat_variables(f, t)
+    xor = OPS.index('^') if t.native_xor else -1
+
+    for i, (kind, op, kids, polarity) in enumerate(zip(f.kinds, f.ops, f.children, f.polarities)):
+        if kind == OPERATION:
+            gate = tuple(variables[j] for j in kids) + (variables[i],)
+            if op == xor:
+                yield Xor(gate, False)
             else:
-                cnf &= ~lit
+                yield from instantiate(OP_TEMPLATES[op][polarity], gate)
+        elif kind == LITERAL:
+            lit = variables[i]
+            yield Clause([lit]) if f.values[i] else Clause([~lit])
 
-    return cnf
+    # Signals whose equation is a plain variable or literal (or shared with another signal)
+    signals = t.signals
+    for sig_str, p in f.roots.items():
+        if variables[p] is not signals[sig_str]:
+            yield from equivalent_clauses(variables[p], signals[sig_str], f.polarities[p])
 
-def transform(c: Circuit, prefix: str='') -> Cnf:
-    '''The function transform takes a Circuit c and returns a Cnf obtained by the
-    Tseitin transformation of c. The optional prefix string will be used for
-    all variable names in the Cnf.
+def unique_clauses(clauses):
+    '''The function unique_clauses yields the given clauses, skipping the ones that were
+    already yielded (with the literals in any order) and the tautological ones, which
+    contain both a literal and its negation. XOR constraints are yielded unchanged.
+    '''
+    seen = set()
+    for cl in clauses:
+        if type(cl) is Xor:
+            yield cl
+            continue
+        lits = frozenset(cl.literals)
+        if lits in seen or any(~l in lits for l in lits):
+            continue
+        seen.add(lits)
+        yield cl
 
+def transform_clauses(c: Circuit, prefix: str='', polarity: dict=None, input_prefix: str=None,
+                      native_xor: bool=False):
+    '''The function transform_clauses takes the same arguments as transform, but yields
+    the clauses (and XOR constraints) of the Tseitin transformation of c one by one instead
+    of returning a Cnf. Each clause is yielded only once.
     '''
-    inputs.clear()
-    signals.clear()
-    solution = Cnf()
+    if polarity is None:
+        polarity = {sig_str: BOTH for sig_str in c.getSignals()}
+    if input_prefix is None:
+        input_prefix = prefix
+    t = TransformState(c, prefix, compute_polarities(c, polarity), input_prefix, native_xor)
+
+    # Obtaining the clauses for each signal (either intern or output)
+    yield from unique_clauses(flat_clauses(FlatCircuit(c, t.polarities), t))
 
-    # Filling input dictionary
-    for in_str in c.getInputs():
-        inputs[in_str] = SatVar(prefix + in_str)
+def transform(c: Circuit, prefix: str='', polarity: dict=None, input_prefix: str=None,
+              native_xor: bool=False) -> Cnf:
+    '''The function transform takes a Circuit c and returns a Cnf obtained by the
+    Tseitin transformation of c. The optional prefix string will be used for
+    all variable names in the Cnf.
 
-    # Filling signals dictionary (outputs and internal signals)
-    for sig_str in c.getSignals():
-        signals[sig_str] = SatVar(prefix + sig_str)
+    The optional polarity dictionary maps signal names to the polarity (POS,
+    NEG or BOTH) in which the signals are used by the caller. If it is given,
+    the Plaisted-Greenbaum encoding is applied: only the clauses required by
+    these polarities are emitted, and signals outside of their cones are left
+    out. Otherwise all signals are transformed in both polarities.
 
-    # Obtaining the CNFs for each signal (either intern or output)
-    for sig_str in c.getSignals():
-        node = c.getEquation(sig_str)
-        solution = solution & transform_node(node, signals[sig_str], c)
+    The optional input_prefix replaces prefix for the names of the inputs. It
+    lets the transformations of two circuits share their input variables.
 
-    return solution
-    pass
+    If native_xor is set, the XOR gates are encoded by XOR constraints instead
+    of clauses, for solvers that handle them natively.
 
+    '''
+    # The Cnf is built only once, from the streamed clauses
+    clauses = []
+    xors = []
+    for cl in transform_clauses(c, prefix, polarity, input_prefix, native_xor):
+        if type(cl) is Xor:
+            xors.append(cl)
+        else:
+            clauses.append(cl)
+    return Cnf(clauses, xors)